@@ -1,11 +1,22 @@
+import asyncio
 import contextlib
+import fcntl
+import hashlib
+import io
+import logging
+import multiprocessing as mp
 import os
 import pickle
 import random
+import shutil
 import string
 import subprocess
 import tempfile
+import uuid
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
 
 import AutoDockTools
 import numpy as np
@@ -16,6 +27,18 @@ from posecheck import PoseCheck
 from rdkit.Chem import AllChem
 from vina import Vina
 
+logger = logging.getLogger(__name__)
+
+_DEVNULL = open(os.devnull, "w")
+_SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+_ATOM_REC = np.frombuffer(b"ATOM", dtype=np.uint8)
+_HETATM_REC = np.frombuffer(b"HETATM", dtype=np.uint8)
+_CONF_CACHE_DIR = Path(os.environ.get("PILOT_CONF_CACHE", "/tmp/pilot_conf_cache"))
+# wall-clock bound (s) for a single conformer embedding in PrepLig.gen_conf
+_EMBED_TIMEOUT = 30
+# docking temp files are never cleaned up, only put them in RAM when there is room
+_SHM_MIN_FREE = 2 * 1024**3
+
 
 def save_pickle(array, path, exist_ok=True):
     if exist_ok:
@@ -28,58 +51,60 @@ def save_pickle(array, path, exist_ok=True):
 
 
 def write_sdf_file(sdf_path, molecules, extract_mol=False):
+    mols = (m.rdkit_mol for m in molecules) if extract_mol else iter(molecules)
     w = Chem.SDWriter(str(sdf_path))
-    for m in molecules:
-        if extract_mol:
-            if m.rdkit_mol is not None:
-                w.write(m.rdkit_mol)
-        else:
+    try:
+        for m in mols:
             if m is not None:
                 w.write(m)
-    w.close()
+    finally:
+        w.close()
 
 
 def retrieve_interactions_per_mol(interactions_df):
     """
     Get a dictionary with interaction metrics per molecule
     """
-    interactions_list = [i[-1] for i in interactions_df.columns]
     interactions_dict = defaultdict(list)
-    for i in range(len(interactions_df)):
-        tmp_dict = defaultdict(list)
-        for k, row in enumerate(interactions_df.iloc[i, :]):
-            tmp_dict[interactions_list[k]].append(row)
-        for key, value in tmp_dict.items():
-            interactions_dict[key].append(np.sum(value))
+    if len(interactions_df) == 0:
+        return interactions_dict, {}
+
+    # sum all columns sharing the same interaction type (last column level)
+    interactions_list = [i[-1] for i in interactions_df.columns]
+    summed = interactions_df.T.groupby(interactions_list, sort=False).sum().T
+    for key in summed.columns:
+        interactions_dict[key] = summed[key].to_numpy().tolist()
 
     interactions = {
-        k: {"mean": np.mean(v), "std": np.std(v)} for k, v in interactions_dict.items()
+        k: {"mean": float(v.mean()), "std": float(v.std(ddof=0))}
+        for k, v in summed.items()
     }
     return interactions_dict, interactions
 
 
 def split_list(data, num_chunks):
-    chunk_size = len(data) // num_chunks
-    remainder = len(data) % num_chunks
-    chunks = []
-    start = 0
-    for i in range(num_chunks):
-        chunk_end = start + chunk_size + (1 if i < remainder else 0)
-        chunks.append(data[start:chunk_end])
-        start = chunk_end
-    return chunks
+    # same partitioning as np.array_split: the first `remainder` chunks get one extra element
+    chunk_size, remainder = divmod(len(data), num_chunks)
+    bounds = [i * chunk_size + min(i, remainder) for i in range(num_chunks + 1)]
+    return [data[bounds[i] : bounds[i + 1]] for i in range(num_chunks)]
 
 
 def get_random_id(length=30):
-    letters = string.ascii_lowercase
-    return "".join(random.choice(letters) for i in range(length))
+    return "".join(random.choices(string.ascii_lowercase, k=length))
+
+
+def _default_tmp_dir():
+    try:
+        free = shutil.disk_usage(_SHM_DIR).free
+    except OSError:
+        free = 0
+    return os.path.join(_SHM_DIR, "pilot_dock") if free >= _SHM_MIN_FREE else "./tmp"
 
 
 def suppress_stdout(func):
     def wrapper(*a, **ka):
-        with open(os.devnull, "w") as devnull:
-            with contextlib.redirect_stdout(devnull):
-                return func(*a, **ka)
+        with contextlib.redirect_stdout(_DEVNULL), contextlib.redirect_stderr(_DEVNULL):
+            return func(*a, **ka)
 
     return wrapper
 
@@ -98,6 +123,99 @@ class BaseDockingTask(object):
         raise NotImplementedError()
 
 
+def _embed_worker(mol, method, conn):
+    params = getattr(Chem.rdDistGeom, method)()
+    params.useRandomCoords = True
+    cid = AllChem.EmbedMolecule(mol, params)
+    conn.send(mol.GetConformer(cid).GetPositions() if cid != -1 else None)
+    conn.close()
+
+
+def _embed_with_timeout(mol, method="ETKDGv3", timeout=_EMBED_TIMEOUT):
+    """
+    Embed mol with the given rdDistGeom parameter set in a child process, since the pinned
+    rdkit has no EmbedParameters.timeout. The child is killed after `timeout` seconds.
+    Returns the conformer positions, or None if the embedding failed or timed out.
+    """
+    ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else None)
+    recv_conn, send_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_embed_worker, args=(mol, method, send_conn))
+    proc.start()
+    send_conn.close()
+    try:
+        positions = recv_conn.recv() if recv_conn.poll(timeout) else None
+    except EOFError:  # the child died without sending a result
+        positions = None
+    finally:
+        recv_conn.close()
+        if proc.is_alive():
+            logger.warning(f"{method} embedding timed out after {timeout} s")
+            proc.terminate()
+        proc.join()
+    return positions
+
+
+def _set_conformer(mol, positions):
+    conf = Chem.Conformer(mol.GetNumAtoms())
+    for i, pos in enumerate(positions):
+        conf.SetAtomPosition(i, pos.tolist())
+    conf.Set3D(True)
+    mol.RemoveAllConformers()
+    mol.AddConformer(conf, assignId=True)
+
+
+def _stereo_labels(mol):
+    """CIP labels of the specified stereocenters and stereo of the specified double bonds."""
+    mol = Chem.Mol(mol)
+    Chem.AssignStereochemistry(mol, cleanIt=True, force=True)
+    atoms = {
+        a.GetIdx(): a.GetProp("_CIPCode")
+        for a in mol.GetAtoms()
+        if a.HasProp("_CIPCode")
+    }
+    bonds = {
+        b.GetIdx(): b.GetStereo()
+        for b in mol.GetBonds()
+        if b.GetStereo()
+        not in (Chem.BondStereo.STEREONONE, Chem.BondStereo.STEREOANY)
+    }
+    return atoms, bonds
+
+
+def _copy_conformer(src_mol, dst_mol, max_matches=1000):
+    """
+    Copy the first conformer of src_mol onto dst_mol, mapping the atoms by substructure
+    match so that the atom order of dst_mol is kept. Only the stereo specified on
+    dst_mol has to be reproduced by the copied coordinates.
+    Returns False if the molecules differ.
+    """
+    if src_mol.GetNumAtoms() != dst_mol.GetNumAtoms():
+        return False
+    # src_mol read from 3D coordinates carries stereo on every center, dst_mol may
+    # leave some unassigned: match the topology and check the specified stereo only
+    query = Chem.Mol(src_mol)
+    Chem.RemoveStereochemistry(query)
+    src_positions = src_mol.GetConformer().GetPositions()
+    target_atoms, target_bonds = _stereo_labels(dst_mol)
+    for match in dst_mol.GetSubstructMatches(
+        query, uniquify=False, maxMatches=max_matches
+    ):
+        positions = np.empty_like(src_positions)
+        positions[list(match)] = src_positions
+        if target_atoms or target_bonds:
+            probe = Chem.Mol(dst_mol)
+            _set_conformer(probe, positions)
+            Chem.AssignStereochemistryFrom3D(probe)
+            atoms, bonds = _stereo_labels(probe)
+            if any(atoms.get(i) != c for i, c in target_atoms.items()) or any(
+                bonds.get(i) != b for i, b in target_bonds.items()
+            ):
+                continue
+        _set_conformer(dst_mol, positions)
+        return True
+    return False
+
+
 class PrepLig(object):
     def __init__(self, input_mol, mol_format):
         if mol_format == "smi":
@@ -114,7 +232,32 @@ class PrepLig(object):
     def gen_conf(self):
         sdf_block = self.ob_mol.write("sdf")
         rdkit_mol = Chem.MolFromMolBlock(sdf_block, removeHs=False)
-        AllChem.EmbedMolecule(rdkit_mol, Chem.rdDistGeom.ETKDGv3())
+
+        # conformers are cached by canonical smiles (incl. hydrogens)
+        smi = Chem.MolToSmiles(rdkit_mol)
+        key = hashlib.sha1(smi.encode()).hexdigest()
+        cache_file = _CONF_CACHE_DIR / f"{key}.sdf"
+        cached = False
+        if cache_file.exists():
+            cached_mol = next(
+                iter(Chem.SDMolSupplier(str(cache_file), removeHs=False)), None
+            )
+            # the cached atom order is the one of the first caller, keep the input mol
+            cached = cached_mol is not None and _copy_conformer(cached_mol, rdkit_mol)
+
+        if not cached:
+            positions = _embed_with_timeout(rdkit_mol, "ETKDGv3", _EMBED_TIMEOUT)
+            if positions is None:
+                # ETKDG can fail (or hang) on pathological macrocycles
+                positions = _embed_with_timeout(rdkit_mol, "ETDG", _EMBED_TIMEOUT)
+            if positions is not None:
+                _set_conformer(rdkit_mol, positions)
+                _CONF_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                tmp_file = _CONF_CACHE_DIR / f"{key}_{get_random_id()}.sdf"
+                with open(tmp_file, "w") as f:
+                    f.write(Chem.MolToMolBlock(rdkit_mol) + "$$$$\n")
+                os.replace(tmp_file, cache_file)
+
         self.ob_mol = pybel.readstring("sdf", Chem.MolToMolBlock(rdkit_mol))
         obutils.writeMolecule(self.ob_mol.OBMol, "conf_h.sdf")
 
@@ -129,71 +272,192 @@ class PrepLig(object):
             return preparator.write_pdbqt_string()
 
 
+def _pdb2pqr_cmd(pdb_file, prot_pqr):
+    return ["pdb2pqr30", "--ff=AMBER", str(pdb_file), str(prot_pqr)]
+
+
+def _prepare_receptor_cmd(prot_pqr, prot_pdbqt):
+    prepare_receptor = os.path.join(
+        AutoDockTools.__path__[0], "Utilities24/prepare_receptor4.py"
+    )
+    return ["python3", prepare_receptor, "-r", str(prot_pqr), "-o", str(prot_pdbqt)]
+
+
 class PrepProt(object):
     def __init__(self, pdb_file):
         self.prot = pdb_file
 
     def del_water(self, dry_pdb_file):  # optional
-        with open(self.prot) as f:
-            lines = [
+        with open(self.prot) as fin, open(dry_pdb_file, "w") as fout:
+            fout.writelines(
                 l
-                for l in f.readlines()
-                if l.startswith("ATOM") or l.startswith("HETATM")
-            ]
-            dry_lines = [l for l in lines if "HOH" not in l]
-
-        with open(dry_pdb_file, "w") as f:
-            f.write("".join(dry_lines))
+                for l in fin
+                if (l.startswith("ATOM") or l.startswith("HETATM")) and "HOH" not in l
+            )
         self.prot = dry_pdb_file
 
     def addH(self, prot_pqr):  # call pdb2pqr
         self.prot_pqr = prot_pqr
         subprocess.Popen(
-            ["pdb2pqr30", "--ff=AMBER", self.prot, self.prot_pqr],
+            _pdb2pqr_cmd(self.prot, self.prot_pqr),
             stderr=subprocess.DEVNULL,
             stdout=subprocess.DEVNULL,
         ).communicate()
 
     def get_pdbqt(self, prot_pdbqt):
-        prepare_receptor = os.path.join(
-            AutoDockTools.__path__[0], "Utilities24/prepare_receptor4.py"
-        )
         subprocess.Popen(
-            ["python3", prepare_receptor, "-r", self.prot_pqr, "-o", prot_pdbqt],
+            _prepare_receptor_cmd(self.prot_pqr, prot_pdbqt),
             stderr=subprocess.DEVNULL,
             stdout=subprocess.DEVNULL,
         ).communicate()
 
 
+async def prep_receptor_async(pdb_path, prot_pqr=None, prot_pdbqt=None):
+    """
+    Async version of PrepProt.addH + PrepProt.get_pdbqt
+    Outputs default to the pdb path with .pqr / .pdbqt suffix.
+    Raises subprocess.CalledProcessError if one of the preparation steps fails.
+    """
+    pdb_path = str(pdb_path)
+    prot_pqr = prot_pqr or pdb_path[:-4] + ".pqr"
+    prot_pdbqt = prot_pdbqt or pdb_path[:-4] + ".pdbqt"
+    for cmd in (
+        _pdb2pqr_cmd(pdb_path, prot_pqr),
+        _prepare_receptor_cmd(prot_pqr, prot_pdbqt),
+    ):
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        if await proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return prot_pqr, prot_pdbqt
+
+
+def prep_receptors_batch(paths, concurrency=os.cpu_count()):
+    """
+    Prepare many receptors with overlapping pdb2pqr30 / prepare_receptor4.py subprocesses.
+    Returns a list of (pqr, pdbqt) paths in the order of `paths`.
+    """
+
+    async def _prep_all():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _prep_one(pdb_path):
+            async with semaphore:
+                return await prep_receptor_async(pdb_path)
+
+        return await asyncio.gather(*(_prep_one(p) for p in paths))
+
+    return asyncio.run(_prep_all())
+
+
+def _cached_prep(pdb_path, cache_dir):
+    """
+    Prepare a receptor (pdb2pqr + prepare_receptor4) once per unique pdb content.
+    Outputs are stored in cache_dir keyed by the sha256 of the pdb file. A file lock makes
+    concurrent workers wait for the first preparation instead of repeating it.
+    Raises subprocess.CalledProcessError if one of the preparation steps fails.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with open(pdb_path, "rb") as f:
+        h = hashlib.sha256(f.read()).hexdigest()
+    pqr_path = cache_dir / f"{h}.pqr"
+    pdbqt_path = cache_dir / f"{h}.pdbqt"
+    if pqr_path.exists() and pdbqt_path.exists():
+        return str(pqr_path), str(pdbqt_path)
+
+    with open(cache_dir / f"{h}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if pqr_path.exists() and pdbqt_path.exists():
+            return str(pqr_path), str(pdbqt_path)
+        tmp_id = get_random_id()
+        tmp_pqr = cache_dir / f"{h}_{tmp_id}.pqr"
+        tmp_pdbqt = cache_dir / f"{h}_{tmp_id}.pdbqt"
+        for cmd in (
+            _pdb2pqr_cmd(pdb_path, tmp_pqr),
+            _prepare_receptor_cmd(tmp_pqr, tmp_pdbqt),
+        ):
+            subprocess.run(
+                cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+            )
+        os.replace(tmp_pqr, pqr_path)
+        os.replace(tmp_pdbqt, pdbqt_path)
+    return str(pqr_path), str(pdbqt_path)
+
+
+def parse_vina_result_score(pdbqt_block):
+    """
+    Get the affinity of the first pose from a docked pdbqt block
+    """
+    for line in pdbqt_block.splitlines():
+        if line.startswith("REMARK VINA RESULT:"):
+            return float(line.split()[3])
+    raise ValueError("No 'REMARK VINA RESULT' line found in docked pdbqt")
+
+
+def first_pdbqt_model(pdbqt_block):
+    """
+    Get the first MODEL ... ENDMDL block from a multi-pose pdbqt block
+    """
+    lines = []
+    for line in pdbqt_block.splitlines(keepends=True):
+        lines.append(line)
+        if line.startswith("ENDMDL"):
+            break
+    return "".join(lines)
+
+
 class VinaDock(object):
-    def __init__(self, lig_pdbqt, prot_pdbqt):
+    def __init__(
+        self, lig_pdbqt, prot_pdbqt, backend="vina", vina_gpu_bin="Vina-GPU-2-1"
+    ):
+        """
+        backend: "vina" for the CPU vina python API, "vina_gpu" to run Vina-GPU 2.1
+            (or QuickVina2-GPU via `vina_gpu_bin`) as a subprocess. Only mode="dock" is
+            run on the GPU; the CPU path is used as fallback when the binary is missing.
+        """
+        if backend not in ("vina", "vina_gpu"):
+            raise ValueError(f"backend {backend} not supported")
         self.lig_pdbqt = lig_pdbqt
         self.prot_pdbqt = prot_pdbqt
+        self.backend = backend
+        self.vina_gpu_bin = vina_gpu_bin
+        # Vina object with computed maps, reused while receptor, box and settings match
+        self._map_key = None
+        self._v = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_map_key"], state["_v"] = None, None
+        return state
 
     def _max_min_pdb(self, pdb, buffer):
-        with open(pdb, "r") as f:
-            lines = [
-                l
-                for l in f.readlines()
-                if l.startswith("ATOM") or l.startswith("HEATATM")
-            ]
-            xs = [float(l[31:39]) for l in lines]
-            ys = [float(l[39:47]) for l in lines]
-            zs = [float(l[47:55]) for l in lines]
-            print(max(xs), min(xs))
-            print(max(ys), min(ys))
-            print(max(zs), min(zs))
-            pocket_center = [
-                (max(xs) + min(xs)) / 2,
-                (max(ys) + min(ys)) / 2,
-                (max(zs) + min(zs)) / 2,
-            ]
-            box_size = [
-                (max(xs) - min(xs)) + buffer,
-                (max(ys) - min(ys)) + buffer,
-                (max(zs) - min(zs)) + buffer,
-            ]
-            return pocket_center, box_size
+        with open(pdb, "rb") as f:
+            raw = f.read()
+        # select ATOM/HETATM records by checking the record name bytes of every line at once
+        buf = np.frombuffer(raw + b"\n" * 6, dtype=np.uint8)
+        newlines = np.flatnonzero(buf[: len(raw)] == ord("\n"))
+        starts = np.concatenate(([0], newlines + 1))
+        ends = np.concatenate((newlines, [len(raw)]))
+        is_atom = np.all(buf[starts[:, None] + np.arange(4)] == _ATOM_REC, axis=1)
+        is_hetatm = np.all(buf[starts[:, None] + np.arange(6)] == _HETATM_REC, axis=1)
+        keep = is_atom | is_hetatm
+        lines = b"\n".join(raw[s:e] for s, e in zip(starts[keep], ends[keep]))
+        xyz = np.genfromtxt(
+            io.BytesIO(lines),
+            delimiter=(30, 8, 8, 8),
+            usecols=(1, 2, 3),
+            dtype=np.float32,
+            ndmin=2,
+        )
+        xyz_max, xyz_min = xyz.max(0), xyz.min(0)
+        if logger.isEnabledFor(logging.DEBUG):
+            for hi, lo in zip(xyz_max, xyz_min):
+                logger.debug(f"{hi} {lo}")
+        pocket_center = ((xyz_max + xyz_min) / 2).tolist()
+        box_size = ((xyz_max - xyz_min) + buffer).tolist()
+        return pocket_center, box_size
 
     def get_box(self, ref=None, buffer=0):
         """
@@ -208,7 +472,42 @@ class VinaDock(object):
         if ref is None:
             ref = self.prot_pdbqt
         self.pocket_center, self.box_size = self._max_min_pdb(ref, buffer)
-        print(self.pocket_center, self.box_size)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{self.pocket_center} {self.box_size}")
+
+    def _use_gpu(self, mode):
+        return (
+            self.backend == "vina_gpu"
+            and mode == "dock"
+            and shutil.which(self.vina_gpu_bin) is not None
+        )
+
+    def _dock_gpu(self, exhaustiveness=8, thread=8000, seed=0):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config_file = os.path.join(tmp_dir, "config.txt")
+            out_file = os.path.join(tmp_dir, "out.pdbqt")
+            config = {
+                "receptor": self.prot_pdbqt,
+                "ligand": self.lig_pdbqt,
+                "thread": thread,
+                "search_depth": exhaustiveness,
+                "seed": seed,
+            }
+            for axis, c, s in zip("xyz", self.pocket_center, self.box_size):
+                config[f"center_{axis}"] = float(c)
+                config[f"size_{axis}"] = float(s)
+            with open(config_file, "w") as f:
+                f.write("".join(f"{k} = {v}\n" for k, v in config.items()))
+
+            subprocess.run(
+                [self.vina_gpu_bin, "--config", config_file, "--out", out_file],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+            with open(out_file, "r") as f:
+                pose = first_pdbqt_model(f.read())
+        return parse_vina_result_score(pose), pose
 
     def dock(
         self,
@@ -219,37 +518,89 @@ class VinaDock(object):
         save_pose=False,
         **kwargs,
     ):  # seed=0 mean random seed
-        v = Vina(sf_name=score_func, seed=seed, verbosity=0, **kwargs)
-        v.set_receptor(self.prot_pdbqt)
+        if self._use_gpu(mode):
+            score, pose = self._dock_gpu(exhaustiveness=exhaustiveness, seed=seed)
+            return score if not save_pose else (score, pose)
+
+        # single-threaded by default so process-level parallelism is not oversubscribed;
+        # pass cpu=os.cpu_count() for a standalone multi-threaded run
+        cpu = kwargs.pop("cpu", 1)
+        key = (
+            score_func,
+            seed,
+            cpu,
+            tuple(sorted(kwargs.items())),
+            self.prot_pdbqt,
+            tuple(float(c) for c in self.pocket_center),
+            tuple(float(s) for s in self.box_size),
+        )
+        if self._map_key != key or self._v is None:
+            v = Vina(sf_name=score_func, seed=seed, verbosity=0, cpu=cpu, **kwargs)
+            v.set_receptor(self.prot_pdbqt)
+            # maps computed before a ligand is set cover all atom types (as in
+            # VinaBatchDock), so the maps stay valid when the ligand changes
+            v.compute_vina_maps(center=self.pocket_center, box_size=self.box_size)
+            self._map_key, self._v = key, v
+        v = self._v
         v.set_ligand_from_file(self.lig_pdbqt)
-        v.compute_vina_maps(center=self.pocket_center, box_size=self.box_size)
+        return _run_vina(v, mode, exhaustiveness, save_pose)
+
+
+def _run_vina(v, mode, exhaustiveness=8, save_pose=False):
+    """
+    Score, minimize or dock the ligand currently set on an initialized Vina object
+    """
+    if mode == "score_only":
+        score = v.score()[0]
+    elif mode == "minimize":
+        score = v.optimize()[0]
+    elif mode == "dock":
+        v.dock(exhaustiveness=exhaustiveness, n_poses=1)
+        score = v.energies(n_poses=1)[0][0]
+    else:
+        raise ValueError
+
+    if not save_pose:
+        return score
+    else:
         if mode == "score_only":
-            score = v.score()[0]
+            pose = None
         elif mode == "minimize":
-            score = v.optimize()[0]
+            # Vina.poses only holds docking results, the optimized pose has to go through a file
+            pose_file = os.path.join(_SHM_DIR, f"{uuid.uuid4().hex}.pdbqt")
+            v.write_pose(pose_file, overwrite=True)
+            try:
+                with open(pose_file, "r") as f:
+                    pose = f.read()
+            finally:
+                os.unlink(pose_file)
         elif mode == "dock":
-            v.dock(exhaustiveness=exhaustiveness, n_poses=1)
-            score = v.energies(n_poses=1)[0][0]
+            pose = v.poses(n_poses=1)
         else:
             raise ValueError
+        return score, pose
 
-        if not save_pose:
-            return score
-        else:
-            if mode == "score_only":
-                pose = None
-            elif mode == "minimize":
-                tmp = tempfile.NamedTemporaryFile()
-                with open(tmp.name, "w") as f:
-                    v.write_pose(tmp.name, overwrite=True)
-                with open(tmp.name, "r") as f:
-                    pose = f.read()
 
-            elif mode == "dock":
-                pose = v.poses(n_poses=1)
-            else:
-                raise ValueError
-            return score, pose
+class VinaBatchDock(object):
+    """
+    Dock many ligands against one receptor with a single Vina object.
+    The receptor is set and the Vina maps are computed only once.
+    """
+
+    def __init__(self, prot_pdbqt, center, box_size, sf="vina", seed=0, **kwargs):
+        self.prot_pdbqt = prot_pdbqt
+        self.pocket_center = list(center)
+        self.box_size = list(box_size)
+        self.v = Vina(
+            sf_name=sf, seed=seed, verbosity=0, cpu=kwargs.pop("cpu", 1), **kwargs
+        )
+        self.v.set_receptor(self.prot_pdbqt)
+        self.v.compute_vina_maps(center=self.pocket_center, box_size=self.box_size)
+
+    def dock_many(self, lig_pdbqt_paths, exhaustiveness=8, mode="dock"):
+        for lig_pdbqt in lig_pdbqt_paths:
+            self.v.set_ligand_from_file(str(lig_pdbqt))
+            yield _run_vina(self.v, mode, exhaustiveness, save_pose=True)
 
 
 class VinaDockingTask(BaseDockingTask):
@@ -281,8 +632,8 @@ class VinaDockingTask(BaseDockingTask):
         protein_path,
         ligand_rdmol,
         ligand_pdbqt,
-        protein_pdbqt,
-        tmp_dir="./tmp",
+        protein_pdbqt=None,
+        tmp_dir=None,
         center=None,
         size_factor=1.0,
         buffer=5.0,
@@ -290,11 +641,15 @@ class VinaDockingTask(BaseDockingTask):
     ):
         super().__init__(protein_path, ligand_rdmol)
         # self.conda_env = conda_env
+        if tmp_dir is None:
+            # temp files do not need disk durability, keep them in RAM if possible
+            tmp_dir = _default_tmp_dir()
         self.tmp_dir = os.path.realpath(tmp_dir)
         os.makedirs(tmp_dir, exist_ok=True)
 
         self.ligand_pdbqt = ligand_pdbqt
         self.protein_pdbqt = protein_pdbqt
+        self.receptor_cache_dir = os.path.join(self.tmp_dir, "_recv_cache")
 
         self.task_id = get_random_id()
         self.receptor_id = self.task_id + "_receptor"
@@ -304,49 +659,111 @@ class VinaDockingTask(BaseDockingTask):
         self.ligand_path = os.path.join(self.tmp_dir, self.ligand_id + ".sdf")
 
         self.recon_ligand_mol = ligand_rdmol
-        ligand_rdmol = Chem.AddHs(ligand_rdmol, addCoords=True)
-
-        sdf_writer = Chem.SDWriter(self.ligand_path)
-        sdf_writer.write(ligand_rdmol)
-        sdf_writer.close()
+        # skip hydrogen placement for ligands that were already protonated upstream,
+        # check on a copy to leave the caller's molecule (recon_ligand_mol) untouched
+        probe = Chem.Mol(ligand_rdmol)
+        probe.UpdatePropertyCache(strict=False)
+        if any(a.GetTotalNumHs() > 0 for a in probe.GetAtoms()):
+            ligand_rdmol = Chem.AddHs(ligand_rdmol, addCoords=True)
+
+        # the sdf is only needed to prepare a ligand pdbqt that was not given
+        if self.ligand_pdbqt is None or not os.path.exists(self.ligand_pdbqt):
+            sdf_writer = Chem.SDWriter(self.ligand_path)
+            sdf_writer.write(ligand_rdmol)
+            sdf_writer.close()
         self.ligand_rdmol = ligand_rdmol
 
         pos = ligand_rdmol.GetConformer(0).GetPositions()
         # if pos is None:
         #    raise ValueError('pos is None')
+        lo, hi = pos.min(axis=0), pos.max(axis=0)
         if center is None:
-            self.center = (pos.max(0) + pos.min(0)) / 2
+            self.center = (hi + lo) * 0.5
         else:
             self.center = center
 
         if size_factor is None:
             self.size_x, self.size_y, self.size_z = 20, 20, 20
         else:
-            self.size_x, self.size_y, self.size_z = (
-                pos.max(0) - pos.min(0)
-            ) * size_factor + buffer
+            self.size_x, self.size_y, self.size_z = (hi - lo) * size_factor + buffer
 
+        self.vina_dock = None
         self.proc = None
         self.results = None
         self.output = None
         self.error_output = None
         self.docked_sdf_path = None
 
-    def run(self, mode="dock", exhaustiveness=8, **kwargs):
-        ligand_pdbqt = self.ligand_path[:-4] + ".pdbqt"
-        protein_pqr = self.receptor_path[:-4] + ".pqr"
-        protein_pdbqt = self.receptor_path[:-4] + ".pdbqt"
+    @classmethod
+    def dock_batch(
+        cls, tasks, mode="dock", exhaustiveness=8, center=None, box_size=None, **kwargs
+    ):
+        """
+        Run tasks that share one receptor with a single VinaBatchDock.
+        The docking box is given by `center` / `box_size`; if omitted, all tasks must
+        share the same box so that the scores stay comparable with `run`.
+        """
+        tasks = list(tasks)
+        if len(tasks) == 0:
+            return []
+        receptors = {
+            (
+                str(t.protein_pdbqt)
+                if t.protein_pdbqt is not None
+                else os.path.realpath(t.receptor_path)
+            )
+            for t in tasks
+        }
+        if len(receptors) != 1:
+            raise ValueError("dock_batch requires all tasks to share one receptor")
+        if tasks[0].protein_pdbqt is None:
+            _, protein_pdbqt = _cached_prep(
+                tasks[0].receptor_path, tasks[0].receptor_cache_dir
+            )
+            for task in tasks:
+                task.protein_pdbqt = protein_pdbqt
+
+        if center is None or box_size is None:
+            centers = np.array([t.center for t in tasks], dtype=float)
+            sizes = np.array(
+                [[t.size_x, t.size_y, t.size_z] for t in tasks], dtype=float
+            )
+            if not (np.allclose(centers, centers[0]) and np.allclose(sizes, sizes[0])):
+                raise ValueError(
+                    "dock_batch requires all tasks to share one docking box, "
+                    "pass center and box_size explicitly otherwise"
+                )
+            center = centers[0] if center is None else center
+            box_size = sizes[0] if box_size is None else box_size
+
+        batch = VinaBatchDock(str(tasks[0].protein_pdbqt), center, box_size, **kwargs)
+        return [
+            [{"affinity": score, "pose": pose}]
+            for score, pose in batch.dock_many(
+                [t.ligand_pdbqt for t in tasks],
+                exhaustiveness=exhaustiveness,
+                mode=mode,
+            )
+        ]
 
+    def run(self, mode="dock", exhaustiveness=8, backend="vina", **kwargs):
         # lig = PrepLig(self.ligand_path, "sdf")
         # lig.get_pdbqt(ligand_pdbqt)
 
-        # prot = PrepProt(self.receptor_path)
-        # if not os.path.exists(protein_pqr):
-        #     prot.addH(protein_pqr)
-        # if not os.path.exists(protein_pdbqt):
-        #     prot.get_pdbqt(protein_pdbqt)
-
-        dock = VinaDock(str(self.ligand_pdbqt), str(self.protein_pdbqt))
+        if self.protein_pdbqt is None:
+            _, self.protein_pdbqt = _cached_prep(
+                self.receptor_path, self.receptor_cache_dir
+            )
+
+        # keep the VinaDock across runs so score_only -> minimize -> dock reuses the maps
+        dock = self.vina_dock
+        if dock is None or dock.backend != backend:
+            dock = VinaDock(
+                str(self.ligand_pdbqt), str(self.protein_pdbqt), backend=backend
+            )
+            self.vina_dock = dock
+        dock.lig_pdbqt = str(self.ligand_pdbqt)
+        dock.prot_pdbqt = str(self.protein_pdbqt)
         dock.pocket_center, dock.box_size = self.center, [
             self.size_x,
             self.size_y,
@@ -372,6 +789,27 @@ class VinaDockingTask(BaseDockingTask):
         return {"clashes": clashes[0], "strain": strain[0]}
 
 
+def _run_one(task, mode="dock", exhaustiveness=8, **kwargs):
+    return task.run(mode=mode, exhaustiveness=exhaustiveness, **kwargs)
+
+
+def run_many(tasks, n_workers=os.cpu_count(), mode="dock", exhaustiveness=8):
+    """
+    Run independent docking tasks in a process pool.
+    Vina is pinned to a single thread per task so that the workers do not oversubscribe the machine.
+    Returns the results of `task.run` in the order of `tasks`.
+    """
+    tasks = list(tasks)
+    if len(tasks) == 0:
+        return []
+    run_fn = partial(_run_one, mode=mode, exhaustiveness=exhaustiveness, cpu=1)
+    chunksize = max(1, len(tasks) // (4 * n_workers))
+    with ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=mp.get_context("spawn")
+    ) as executor:
+        return list(executor.map(run_fn, tasks, chunksize=chunksize))
+
+
 # if __name__ == '__main__':
 #     lig_pdbqt = 'data/lig.pdbqt'
 #     mol_file = 'data/1a4k_ligand.sdf'
@@ -1,26 +1,231 @@
 import itertools
 import logging
 from collections import Counter
-from multiprocessing import Pool
+from functools import lru_cache
 
 import numpy as np
 import torch
+from joblib import Parallel, delayed, effective_n_jobs
 from rdkit import Chem, RDLogger
 from rdkit.Chem.QED import qed
 from rdkit.DataStructs import BulkTanimotoSimilarity, TanimotoSimilarity
-from torchmetrics import MaxMetric, MeanMetric
 from tqdm import tqdm
 
 from experiments.sampling.utils import *
-from experiments.sampling.utils import dihedral_distance
+from experiments.sampling.utils import _calculate_pc_descriptors, dihedral_distance
 
 lg = RDLogger.logger()
 lg.setLevel(RDLogger.CRITICAL)
 logging.getLogger("openbabel").setLevel(logging.CRITICAL)
 
+# Molecules, fingerprints and descriptors are shared between the similarity, diversity
+# and KL metrics and cached by canonical smiles. The caches are module-level, so they
+# persist across BasicMolecularMetrics instances (analyze_stability_for_molecules builds a
+# new one per call) and are bounded for that reason. Cached objects must not be mutated.
+_CACHE_SIZE = 2**15
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def _mol_from_smiles(smiles):
+    return Chem.MolFromSmiles(smiles)
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def _fp_from_smiles(smiles):
+    mol = _mol_from_smiles(smiles)
+    if mol is None:
+        return None
+    return get_fingerprints([mol])[0]
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def _descriptors(smiles, pc_descriptors):
+    return _calculate_pc_descriptors(smiles, list(pc_descriptors))
+
+
+def _fps_from_smileslist(smiles_list):
+    fps = (_fp_from_smiles(s) for s in smiles_list)
+    return [fp for fp in fps if fp is not None]
+
+
+def _same_bond_orders(initial_bo, rdmol):
+    """Compare bond orders of rdmol with {(begin, end): order} before sanitization."""
+    if rdmol.GetNumBonds() != len(initial_bo):
+        return False
+    for bond in rdmol.GetBonds():
+        i, j = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
+        bo = initial_bo.get((i, j), initial_bo.get((j, i)))
+        if bo is None or abs(bo - bond.GetBondTypeAsDouble()) >= 1:
+            return False
+    return True
+
+
+def _check_validity(rdmol, strict=True):
+    """
+    Validity check of a single rdkit molecule, see BasicMolecularMetrics.compute_validity.
+    The molecule is sanitized in place once, like compute_sanitize_validity used to do.
+    Returns (status, number of components, smiles, smiles without stereo, sanitized); status is
+    None for a missing molecule and "passed" for a valid one. sanitized tells whether
+    Chem.SanitizeMol succeeded on the whole molecule, independent of the other checks.
+    """
+    if rdmol is None:
+        return None, None, None, None, False
+    num_components = None
+    sanitized = False
+    # sanitization changes bond order without throwing exceptions for certain cases,
+    # keep the initial ones for the strict check
+    initial_bo = (
+        {
+            (b.GetBeginAtomIdx(), b.GetEndAtomIdx()): b.GetBondTypeAsDouble()
+            for b in rdmol.GetBonds()
+        }
+        if strict
+        else None
+    )
+    sanitize_error = None
+    try:
+        Chem.SanitizeMol(rdmol)
+        sanitized = True
+    except ValueError as e:
+        sanitize_error = e
+    try:
+        num_components = len(Chem.rdmolops.GetMolFrags(rdmol))
+        if num_components > 1:
+            return "disconnected", num_components, None, None, sanitized
+        # a single fragment is the whole molecule, so its sanitization is the one above
+        if sanitize_error is not None:
+            raise sanitize_error
+        num_hs = num_radicals = 0
+        for a in rdmol.GetAtoms():
+            num_hs += a.GetNumImplicitHs()
+            num_radicals += a.GetNumRadicalElectrons()
+        if num_hs > 0:
+            return "implicit_hydrogens", num_components, None, None, sanitized
+        if strict:
+            # https://github.com/rdkit/rdkit/blob/master/Docs/Book/RDKit_Book.rst#molecular-sanitization
+            # only consider change in BO to be wrong when difference is > 0.5 (not just kekulization difference)
+            if not _same_bond_orders(initial_bo, rdmol):
+                return "wrong_bo", num_components, None, None, sanitized
+            # atom valencies are only correct when unpaired electrons are added
+            # when training data does not contain open shell systems, this should be considered an error
+            if num_radicals > 0:
+                return "radicals", num_components, None, None, sanitized
+        # explicit hydrogens are graph nodes for some models, drop them so the smiles
+        # match the canonical form of canonicalize_list (and of the train smiles)
+        rdmol_noh = Chem.RemoveHs(rdmol)
+        return (
+            "passed",
+            num_components,
+            Chem.MolToSmiles(rdmol_noh),
+            Chem.MolToSmiles(rdmol_noh, isomericSmiles=False),
+            sanitized,
+        )
+    except Chem.rdchem.AtomValenceException:
+        return "wrong_atom_valence", num_components, None, None, sanitized
+    except Chem.rdchem.KekulizeException:
+        return "kekulization", num_components, None, None, sanitized
+    except ValueError:
+        return "other", num_components, None, None, sanitized
+
+
+def _check_validity_chunk(rdmols, strict=True):
+    return [_check_validity(rdmol, strict) for rdmol in rdmols]
+
+
+def _split_chunks(items, n_chunks):
+    n_chunks = max(1, min(n_chunks, len(items)))
+    bounds = np.linspace(0, len(items), n_chunks + 1, dtype=int)
+    return [items[bounds[i] : bounds[i + 1]] for i in range(n_chunks)]
+
+
+def _fingerprints_parallel(smiles_list, n_jobs=-1):
+    chunks = _split_chunks(list(smiles_list), effective_n_jobs(n_jobs))
+    fps = Parallel(n_jobs=n_jobs, backend="loky")(
+        delayed(get_fingerprints_from_smileslist)(chunk) for chunk in chunks
+    )
+    return [fp for chunk in fps for fp in chunk]
+
+
+def _bulk_tanimoto_block(fps, ref_fps):
+    return np.array([BulkTanimotoSimilarity(fp, ref_fps) for fp in fps]).reshape(
+        len(fps), len(ref_fps)
+    )
+
+
+def _bulk_tanimoto_upper_rows(fps, rows):
+    sims = [BulkTanimotoSimilarity(fps[i], fps[i + 1 :]) for i in rows]
+    return np.concatenate(sims) if sims else np.empty(0)
+
+
+def _descriptors_from_smileslist(smiles_list, pc_descriptors):
+    d = (_descriptors(s, tuple(pc_descriptors)) for s in smiles_list)
+    return np.array([x for x in d if x is not None])
+
+
+def _as_array(x):
+    if isinstance(x, torch.Tensor):
+        x = x.detach().cpu()
+    return np.asarray(x, dtype=np.float64)
+
+
+class _Mean:
+    """Weighted running mean with the update/compute/reset subset of torchmetrics.MeanMetric.
+
+    Values may be python scalars, numpy arrays or tensors; NaN values are dropped like
+    MeanMetric does. compute() returns a numpy scalar so ``.item()`` keeps working.
+    """
+
+    __slots__ = ("s", "w")
+
+    def __init__(self):
+        self.reset()
+
+    def update(self, value, weight=1.0):
+        value = _as_array(value)
+        weight = np.broadcast_to(_as_array(weight), value.shape)
+        keep = ~np.isnan(value)
+        self.s += float((value[keep] * weight[keep]).sum())
+        self.w += float(weight[keep].sum())
+
+    __call__ = update
+
+    @property
+    def weight(self):
+        return np.float64(self.w)
+
+    def compute(self):
+        return np.float64(self.s / self.w) if self.w else np.float64(np.nan)
+
+    def reset(self):
+        self.s = self.w = 0.0
+
+
+class _Max:
+    """Running max with the update/compute/reset subset of torchmetrics.MaxMetric."""
+
+    __slots__ = ("m",)
+
+    def __init__(self):
+        self.reset()
+
+    def update(self, value):
+        value = _as_array(value)
+        if value.size:
+            self.m = max(self.m, float(np.nanmax(value)))
+
+    __call__ = update
+
+    def compute(self):
+        return np.float64(self.m)
+
+    def reset(self):
+        self.m = -np.inf
+
 
 class BasicMolecularMetrics(object):
-    def __init__(self, dataset_info, smiles_train=None, test=False, device="cpu"):
+    def __init__(
+        self, dataset_info, smiles_train=None, test=False, device="cpu", n_jobs=1
+    ):
         self.atom_decoder = (
             dataset_info["atom_decoder"]
             if isinstance(dataset_info, dict)
@@ -29,30 +234,35 @@ class BasicMolecularMetrics(object):
         self.dataset_info = dataset_info
 
         self.device = device
+        # joblib workers for the rdkit validity checks, see compute_validity
+        self.n_jobs = n_jobs
 
         self.number_samples = 0  # update based on unique generated smiles
         self.train_smiles, _ = canonicalize_list(smiles_train)
+        # set view of the train smiles for O(1) novelty lookups
+        self.train_smiles_set = frozenset(self.train_smiles)
 
-        self.train_fps = get_fingerprints_from_smileslist(self.train_smiles)
+        self.train_fps = get_fingerprints_from_mols(get_mols(self.train_smiles))
         self.test = test
 
-        self.atom_stable = MeanMetric().to(device)
-        self.mol_stable = MeanMetric().to(device)
+        # plain running accumulators, the metrics only ever see host scalars
+        self.atom_stable = _Mean()
+        self.mol_stable = _Mean()
 
         # Retrieve dataset smiles.
-        self.validity_metric = MeanMetric().to(device)
-        self.uniqueness = MeanMetric().to(device)
-        self.novelty = MeanMetric().to(device)
-        self.mean_components = MeanMetric().to(device)
-        self.max_components = MaxMetric().to(device)
-        self.num_nodes_w1 = MeanMetric().to(device)
-        self.atom_types_tv = MeanMetric().to(device)
-        self.edge_types_tv = MeanMetric().to(device)
-        self.charge_w1 = MeanMetric().to(device)
-        self.valency_w1 = MeanMetric().to(device)
-        self.bond_lengths_w1 = MeanMetric().to(device)
-        self.angles_w1 = MeanMetric().to(device)
-        self.dihedrals_w1 = MeanMetric().to(device)
+        self.validity_metric = _Mean()
+        self.uniqueness = _Mean()
+        self.novelty = _Mean()
+        self.mean_components = _Mean()
+        self.max_components = _Max()
+        self.num_nodes_w1 = _Mean()
+        self.atom_types_tv = _Mean()
+        self.edge_types_tv = _Mean()
+        self.charge_w1 = _Mean()
+        self.valency_w1 = _Mean()
+        self.bond_lengths_w1 = _Mean()
+        self.angles_w1 = _Mean()
+        self.dihedrals_w1 = _Mean()
 
         self.pc_descriptor_subset = [
             "BertzCT",
@@ -86,63 +296,55 @@ class BasicMolecularMetrics(object):
         ]:
             metric.reset()
 
-    def compute_validity(self, generated, local_rank=0, strict=True):
+    def compute_validity(self, generated, local_rank=0, strict=True, n_jobs=None):
         """generated: list of couples (positions, atom_types)
         strict (bool, default=True): Weather a change in bond order by sanitization
                                      or open shell systems should be considered an error.
                                      If training data is sanitized and closed shell systems
-                                     only, this should throw an error."""
+                                     only, this should throw an error.
+        n_jobs (int, default=None): joblib workers for the rdkit checks, defaults to the
+                                    n_jobs given to the constructor. Worker start-up
+                                    and pickling usually outweigh the checks for
+                                    batches of a few hundred molecules."""
         valid_smiles = []
         valid_ids = []
         valid_molecules = []
         num_components = []
         error_message = Counter()
-        for i, mol in enumerate(generated):
-            rdmol = mol.rdkit_mol
-            if rdmol is not None:
-                initial_adj = Chem.GetAdjacencyMatrix(rdmol, useBO=True, force=True)
-                try:
-                    mol_frags = Chem.rdmolops.GetMolFrags(
-                        rdmol, asMols=True, sanitizeFrags=False
-                    )
-                    num_components.append(len(mol_frags))
-                    if len(mol_frags) > 1:
-                        error_message["disconnected"] += 1
-                        continue
-                    rdmol = mol_frags[0]
+
+        # the rdkit checks are independent per molecule and can run on chunks in joblib
+        # workers
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+        rdmols = [mol.rdkit_mol for mol in generated]
+        if n_jobs == 1:
+            results = _check_validity_chunk(rdmols, strict)
+        else:
+            chunks = _split_chunks(rdmols, effective_n_jobs(n_jobs))
+            results = Parallel(n_jobs=n_jobs, backend="loky")(
+                delayed(_check_validity_chunk)(chunk, strict) for chunk in chunks
+            )
+            results = [r for chunk_results in results for r in chunk_results]
+            # the workers sanitized pickled copies, callers get their molecules back
+            # sanitized in place
+            for rdmol, result in zip(rdmols, results):
+                if result[4]:
                     Chem.SanitizeMol(rdmol)
-                    if sum([a.GetNumImplicitHs() for a in rdmol.GetAtoms()]) > 0:
-                        error_message["implicit_hydrogens"] += 1
-                        continue
-                    if strict:
-                        # sanitization changes bond order without throwing exceptions for certain cases
-                        # https://github.com/rdkit/rdkit/blob/master/Docs/Book/RDKit_Book.rst#molecular-sanitization
-                        # only consider change in BO to be wrong when difference is > 0.5 (not just kekulization difference)
-                        adj2 = Chem.GetAdjacencyMatrix(rdmol, useBO=True, force=True)
-                        if not np.all(np.abs(initial_adj - adj2) < 1):
-                            error_message["wrong_bo"] += 1
-                            continue
-                        # atom valencies are only correct when unpaired electrons are added
-                        # when training data does not contain open shell systems, this should be considered an error
-                        if (
-                            sum([a.GetNumRadicalElectrons() for a in rdmol.GetAtoms()])
-                            > 0
-                        ):
-                            error_message["radicals"] += 1
-                            continue
-                    smiles = Chem.MolToSmiles(rdmol)
-                    valid_smiles.append(smiles)
-                    valid_ids.append(i)
-                    valid_molecules.append(mol)
-                    error_message["passed"] += 1
-                except Chem.rdchem.AtomValenceException:
-                    error_message["wrong_atom_valence"] += 1
-                    # print("Valence error in GetmolFrags")
-                except Chem.rdchem.KekulizeException:
-                    error_message["kekulization"] += 1
-                    # print("Can't kekulize molecule")
-                except ValueError:
-                    error_message["other"] += 1
+        # sanitization outcome per molecule, for compute_sanitize_validity
+        sanitize_ok = []
+        valid_smiles_nostereo = []
+        for i, (mol, result) in enumerate(zip(generated, results)):
+            status, n_components, smiles, smiles_nostereo, sanitized = result
+            sanitize_ok.append(sanitized)
+            if status is None:
+                continue
+            error_message[status] += 1
+            if n_components is not None:
+                num_components.append(n_components)
+            if status == "passed":
+                valid_smiles.append(smiles)
+                valid_smiles_nostereo.append(smiles_nostereo)
+                valid_ids.append(i)
+                valid_molecules.append(mol)
         if local_rank == 0:
             print(
                 "Error messages:\n"
@@ -155,25 +357,45 @@ class BasicMolecularMetrics(object):
         self.validity_metric.update(
             value=len(valid_smiles) / len(generated), weight=len(generated)
         )
-        num_components = torch.tensor(
-            num_components, device=self.mean_components.device
-        )
+        num_components = np.asarray(num_components)
         self.mean_components.update(num_components)
         self.max_components.update(num_components)
         not_connected = 100.0 * error_message["disconnected"] / len(generated)
         connected_components = 100.0 - not_connected
 
-        valid_smiles, duplicate_ids = canonicalize_list(valid_smiles)
-        valid_molecules = [
-            mol for i, mol in enumerate(valid_molecules) if i not in duplicate_ids
-        ]
+        # smiles from Chem.MolToSmiles are already canonical, only drop duplicates
+        seen = set()
+        kept_smiles = []
+        kept_smiles_nostereo = []
+        kept_molecules = []
+        for smiles, smiles_nostereo, mol in zip(
+            valid_smiles, valid_smiles_nostereo, valid_molecules
+        ):
+            if smiles in seen:
+                continue
+            seen.add(smiles)
+            kept_smiles.append(smiles)
+            kept_smiles_nostereo.append(smiles_nostereo)
+            kept_molecules.append(mol)
 
-        return valid_smiles, valid_molecules, connected_components, error_message
+        return (
+            kept_smiles,
+            kept_molecules,
+            connected_components,
+            error_message,
+            kept_smiles_nostereo,
+            sanitize_ok,
+        )
 
-    def compute_sanitize_validity(self, generated):
+    def compute_sanitize_validity(self, generated, sanitize_ok=None):
+        """sanitize_ok: per molecule sanitization outcome returned by compute_validity,
+        which already sanitized the molecules in place."""
         if len(generated) < 1:
             return -1.0
 
+        if sanitize_ok is not None:
+            return sum(sanitize_ok) / len(sanitize_ok)
+
         valid = []
         for mol in generated:
             rdmol = mol.rdkit_mol
@@ -188,7 +410,8 @@ class BasicMolecularMetrics(object):
 
     def compute_uniqueness(self, valid):
         """valid: list of SMILES strings."""
-        return list(set(valid)), len(set(valid)) / len(valid)
+        unique = list(set(valid))
+        return unique, len(unique) / len(valid)
 
     def compute_novelty(self, unique):
         num_novel = 0
@@ -197,7 +420,7 @@ class BasicMolecularMetrics(object):
             print("Dataset smiles is None, novelty computation skipped")
             return 1, 1
         for smiles in unique:
-            if smiles not in self.train_smiles:
+            if smiles not in self.train_smiles_set:
                 novel.append(smiles)
                 num_novel += 1
         return novel, num_novel / len(unique)
@@ -211,6 +434,8 @@ class BasicMolecularMetrics(object):
             valid_mols,
             connected_components,
             error_message,
+            valid_smiles_nostereo,
+            sanitize_ok,
         ) = self.compute_validity(generated, local_rank=local_rank)
 
         validity = self.validity_metric.compute()
@@ -220,18 +445,13 @@ class BasicMolecularMetrics(object):
 
         # Uniqueness
         if len(valid_smiles) > 0:
-            unique = list(set(valid_smiles))
-            self.uniqueness.update(
-                value=len(unique) / len(valid_smiles), weight=len(valid_smiles)
-            )
+            unique, uniqueness_ratio = self.compute_uniqueness(valid_smiles)
+            self.uniqueness.update(value=uniqueness_ratio, weight=len(valid_smiles))
             uniqueness = self.uniqueness.compute()
 
             if self.train_smiles is not None:
-                novel = []
-                for smiles in unique:
-                    if smiles not in self.train_smiles:
-                        novel.append(smiles)
-                self.novelty.update(value=len(novel) / len(unique), weight=len(unique))
+                _, novelty_ratio = self.compute_novelty(unique)
+                self.novelty.update(value=novelty_ratio, weight=len(unique))
             novelty = self.novelty.compute()
 
         num_molecules = int(self.validity_metric.weight.item())
@@ -255,6 +475,8 @@ class BasicMolecularMetrics(object):
             novelty,
             uniqueness,
             connected_components,
+            valid_smiles_nostereo,
+            sanitize_ok,
         )
 
     def __call__(self, molecules: list, local_rank=0, return_molecules=False):
@@ -262,6 +484,9 @@ class BasicMolecularMetrics(object):
         stable_molecules = []
         if local_rank == 0:
             print("Analyzing molecule stability ...")
+        mol_flags = np.empty(len(molecules), dtype=np.float32)
+        at_ratio = np.empty_like(mol_flags)
+        weights = np.empty_like(mol_flags)
         for i, mol in enumerate(molecules):
             if mol.bond_types is None:
                 mol_stable, at_stable, num_bonds = check_stability_without_bonds(
@@ -271,10 +496,15 @@ class BasicMolecularMetrics(object):
                 mol_stable, at_stable, num_bonds = check_stability(
                     mol, self.dataset_info
                 )
-            self.mol_stable.update(value=mol_stable)
-            self.atom_stable.update(value=at_stable / num_bonds, weight=num_bonds)
+            mol_flags[i] = mol_stable
+            at_ratio[i] = at_stable / num_bonds
+            weights[i] = num_bonds
             if mol_stable:
                 stable_molecules.append(mol)
+        # one metric update for the whole batch instead of one per molecule
+        if len(molecules) > 0:
+            self.mol_stable.update(value=mol_flags)
+            self.atom_stable.update(value=at_ratio, weight=weights)
 
         stability_dict = {
             "mol_stable": self.mol_stable.compute().item(),
@@ -288,16 +518,18 @@ class BasicMolecularMetrics(object):
             novelty,
             uniqueness,
             connected_components,
+            all_generated_smiles_nostereo,
+            sanitize_ok,
         ) = self.evaluate(molecules, local_rank=local_rank)
         # Save in any case in the graphs folder
 
-        sanitize_validity = self.compute_sanitize_validity(molecules)
+        sanitize_validity = self.compute_sanitize_validity(molecules, sanitize_ok)
 
         novelty = novelty if isinstance(novelty, int) else novelty.item()
         uniqueness = uniqueness if isinstance(uniqueness, int) else uniqueness.item()
 
         validity_dict = {
-            "validity": validity.item(),
+            "validity": float(validity),
             "sanitize_validity": sanitize_validity,
             "novelty": novelty,
             "uniqueness": uniqueness,
@@ -314,10 +546,19 @@ class BasicMolecularMetrics(object):
                 if len(all_generated_smiles) <= len(self.train_smiles)
                 else self.train_smiles
             )
-            similarity = self.get_bulk_similarity_with_train(all_generated_smiles)
-            diversity = self.get_bulk_diversity(all_generated_smiles)
+            # fingerprints are computed once and shared by similarity, diversity and KL
+            mols = [_mol_from_smiles(s) for s in all_generated_smiles]
+            fp_smiles_nostereo = [
+                s
+                for s, mol in zip(all_generated_smiles_nostereo, mols)
+                if mol is not None
+            ]
+            mols = [mol for mol in mols if mol is not None]
+            fps = get_fingerprints_from_mols(mols)
+            similarity = self.get_bulk_similarity_with_train(fps)
+            diversity = self.get_bulk_diversity(fps)
             if len(all_generated_smiles) > 0:
-                kl_score = self.get_kl_divergence(all_generated_smiles)
+                kl_score = self.get_kl_divergence(fp_smiles_nostereo, fps)
             else:
                 print("No valid smiles have been generated. Setting kl_score to -1")
                 kl_score = -1.0
@@ -326,10 +567,16 @@ class BasicMolecularMetrics(object):
             statistics_dict["kl_score"] = kl_score
 
             if len(all_generated_smiles) > 0:
-                mols = get_mols_list(all_generated_smiles)
                 # rings = np.mean([num_rings(mol) for mol in mols])
                 # aromatic_rings = np.mean([num_aromatic_rings(mol) for mol in mols])
-                qeds = np.mean([qed(mol) for mol in mols])
+                # valid_molecules is aligned with the deduplicated smiles and was sanitized
+                # in place by compute_validity, score the rdkit molecules directly
+                qeds = np.fromiter(
+                    (qed(m.rdkit_mol) for m in valid_molecules),
+                    dtype=np.float64,
+                    count=len(valid_molecules),
+                )
+                qeds = float(qeds.mean())
             else:
                 print("No valid smiles have been generated. Setting qed_score to -1")
                 qeds = -1.0
@@ -475,67 +722,98 @@ class BasicMolecularMetrics(object):
 
         return statistics_log
 
-    def get_similarity_with_train(self, generated_smiles, parallel=False):
-        fps = get_fingerprints_from_smileslist(generated_smiles)
-        fp_pair = list(itertools.product(fps, self.train_fps))
+    def get_similarity_with_train(self, generated_smiles, parallel=False, n_jobs=-1):
         if not parallel:
-            similarity_list = []
-            for fg1, fg2 in tqdm(fp_pair, desc="Calculate similarity with train"):
-                similarity_list.append(get_similarity((fg1, fg2)))
+            fps = get_fingerprints_from_smileslist(generated_smiles)
+            similarity_list = np.array(
+                [
+                    BulkTanimotoSimilarity(fg1, self.train_fps)
+                    for fg1 in tqdm(fps, desc="Calculate similarity with train")
+                ]
+            ).reshape(len(fps), len(self.train_fps))
         else:
-            with Pool(102) as pool:
-                similarity_list = list(
-                    tqdm(
-                        pool.imap(get_similarity, fp_pair),
-                        total=len(fps) * len(self.train_fps),
-                    )
-                )
+            fps = _fingerprints_parallel(generated_smiles, n_jobs=n_jobs)
+            blocks = Parallel(n_jobs=n_jobs, backend="loky", batch_size="auto")(
+                delayed(_bulk_tanimoto_block)(chunk, self.train_fps)
+                for chunk in _split_chunks(fps, effective_n_jobs(n_jobs))
+            )
+            similarity_list = np.vstack(blocks)
         # calculate the max similarity of each mol with train data
-        similarity_max = np.reshape(similarity_list, (len(generated_smiles), -1)).max(
-            axis=1
-        )
+        similarity_max = similarity_list.max(axis=1)
         return np.mean(similarity_max)
 
-    def get_diversity(self, generated_smiles, parallel=False):
-        fps = get_fingerprints_from_smileslist(generated_smiles)
-        all_fp_pairs = list(itertools.combinations(fps, 2))
+    def get_diversity(self, generated_smiles, parallel=False, n_jobs=-1):
         if not parallel:
+            fps = get_fingerprints_from_smileslist(generated_smiles)
+            all_fp_pairs = list(itertools.combinations(fps, 2))
             similarity_list = []
             for fg1, fg2 in tqdm(all_fp_pairs, desc="Calculate diversity"):
                 similarity_list.append(TanimotoSimilarity(fg1, fg2))
         else:
-            with Pool(102) as pool:
-                similarity_list = pool.imap_unordered(TanimotoSimilarity, all_fp_pairs)
+            fps = _fingerprints_parallel(generated_smiles, n_jobs=n_jobs)
+            # upper triangle rows get shorter, so rows are interleaved across the jobs
+            n_blocks = max(1, effective_n_jobs(n_jobs))
+            blocks = Parallel(n_jobs=n_jobs, backend="loky", batch_size="auto")(
+                delayed(_bulk_tanimoto_upper_rows)(
+                    fps, range(k, len(fps) - 1, n_blocks)
+                )
+                for k in range(n_blocks)
+            )
+            similarity_list = np.concatenate(blocks)
         return 1 - np.mean(similarity_list)
 
-    def get_bulk_similarity_with_train(self, generated_smiles):
-        fps = get_fingerprints_from_smileslist(generated_smiles)
-        scores = []
-
-        for fp in fps:
-            scores.append(BulkTanimotoSimilarity(fp, self.train_fps))
-        return np.mean(scores)
-
-    def get_bulk_diversity(self, generated_smiles):
-        fps = get_fingerprints_from_smileslist(generated_smiles)
-        scores = []
+    def get_bulk_similarity_with_train(self, fps):
+        sims = np.empty((len(fps), len(self.train_fps)), dtype=np.float32)
         for i, fp in enumerate(fps):
-            fps_tmp = fps.copy()
-            del fps_tmp[i]
-            scores.append(BulkTanimotoSimilarity(fp, fps_tmp))
-        return 1 - np.mean(scores)
-
-    def get_kl_divergence(self, generated_smiles):
-        # canonicalize_list in order to remove stereo information (also removes duplicates and invalid molecules, but there shouldn't be any)
-        unique_molecules = set(
-            canonicalize_list(generated_smiles, include_stereocenters=False)[0]
-        )
+            sims[i] = BulkTanimotoSimilarity(fp, self.train_fps)
+        return sims.mean()
+
+    def get_bulk_diversity(self, fps):
+        # similarity is symmetric, so the mean over i < j equals the mean over all i != j
+        n = len(fps)
+        total = 0.0
+        count = 0
+        for i in range(n - 1):
+            sims = BulkTanimotoSimilarity(fps[i], fps[i + 1 :])
+            total += float(np.sum(sims))
+            count += len(sims)
+        if count == 0:
+            return np.nan
+        return 1.0 - total / count
+
+    def _pairwise_max(self, fps):
+        """
+        Max similarity of each fingerprint to all others (diagonal excluded), same as
+        calculate_internal_pairwise_similarities(...).max(axis=1) without the N x N matrix.
+        """
+        n = len(fps)
+        out = np.zeros(n)
+        for i in range(n - 1):
+            row = np.asarray(BulkTanimotoSimilarity(fps[i], fps[i + 1 :]))
+            out[i] = max(out[i], row.max())
+            np.maximum(out[i + 1 :], row, out=out[i + 1 :])
+        return out
+
+    def get_kl_divergence(self, generated_smiles_nostereo, fps):
+        """generated_smiles_nostereo: list of canonical smiles without stereo information
+        (from compute_validity), fps: their fingerprints (same order)"""
+        # remove duplicates after dropping stereo information
+        # the morgan fingerprints ignore chirality, so the fingerprint of the first stereoisomer is kept
+        unique_molecules = []
+        unique_fps = []
+        seen = set()
+        for smiles, fp in zip(generated_smiles_nostereo, fps):
+            if smiles in seen:
+                continue
+            seen.add(smiles)
+            unique_molecules.append(smiles)
+            unique_fps.append(fp)
 
         # first we calculate the descriptors, which are np.arrays of size n_samples x n_descriptors
-        d_sampled = calculate_pc_descriptors(
+        d_sampled = _descriptors_from_smileslist(
             unique_molecules, self.pc_descriptor_subset
         )
-        d_chembl = calculate_pc_descriptors(
+        d_chembl = _descriptors_from_smileslist(
             self.train_subset, self.pc_descriptor_subset
         )
 
@@ -555,11 +833,8 @@ class BasicMolecularMetrics(object):
 
         # pairwise similarity
 
-        chembl_sim = calculate_internal_pairwise_similarities(self.train_subset)
-        chembl_sim = chembl_sim.max(axis=1)
-
-        sampled_sim = calculate_internal_pairwise_similarities(unique_molecules)
-        sampled_sim = sampled_sim.max(axis=1)
+        chembl_sim = self._pairwise_max(_fps_from_smileslist(self.train_subset))
+        sampled_sim = self._pairwise_max(unique_fps)
 
         kldiv_int_int = continuous_kldiv(X_baseline=chembl_sim, X_sampled=sampled_sim)
         kldivs["internal_similarity"] = kldiv_int_int
@@ -579,9 +854,10 @@ def analyze_stability_for_molecules(
     local_rank,
     return_molecules=False,
     device="cpu",
+    n_jobs=1,
 ):
     metrics = BasicMolecularMetrics(
-        dataset_info, smiles_train=smiles_train, device=device
+        dataset_info, smiles_train=smiles_train, device=device, n_jobs=n_jobs
     )
     (
         stability_dict,
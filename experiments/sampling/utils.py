@@ -1041,6 +1041,16 @@ def calculate_internal_pairwise_similarities(
 
     mols = get_mols(smiles_list)
     fps = get_fingerprints(mols)
+    return calculate_internal_pairwise_similarities_from_fps(fps)
+
+
+def calculate_internal_pairwise_similarities_from_fps(fps) -> np.ndarray:
+    """
+    Computes the pairwise similarities of the provided fingerprints against themselves.
+
+    Returns:
+        Symmetric matrix of pairwise similarities. Diagonal is set to zero.
+    """
     nfps = len(fps)
 
     similarities = np.zeros((nfps, nfps))
@@ -1094,7 +1104,21 @@ def get_fingerprints_from_smileslist(smiles_list):
     Returns: ECFP4 bitvectors of length 4096.
 
     """
-    return get_fingerprints(get_mols(smiles_list))
+    return get_fingerprints_from_mols(get_mols(smiles_list))
+
+
+def get_fingerprints_from_mols(mols: Iterable[Chem.Mol]):
+    """
+    Converts already parsed molecules into ECFP4 bitvectors of length 4096,
+    skipping the smiles parsing of get_fingerprints_from_smileslist.
+
+    Args:
+        mols: RDKit molecules
+
+    Returns: ECFP4 bitvectors of length 4096.
+
+    """
+    return get_fingerprints(mols)
 
 
 def get_fingerprints(
@@ -8,15 +8,14 @@ import useful_rdkit_utils as uru
 
 
 def write_sdf_file(sdf_path, molecules, extract_mol=False):
+    mols = (m.rdkit_mol for m in molecules) if extract_mol else iter(molecules)
     w = Chem.SDWriter(str(sdf_path))
-    for m in molecules:
-        if extract_mol:
-            if m.rdkit_mol is not None:
-                w.write(m.rdkit_mol)
-        else:
+    try:
+        for m in mols:
             if m is not None:
                 w.write(m)
-    w.close()
+    finally:
+        w.close()
 
 
 def get_args():
@@ -1490,15 +1490,14 @@ def get_inp_molecules(
 
 
 def write_sdf_file(sdf_path, molecules, extract_mol=False):
+    mols = (m.rdkit_mol for m in molecules) if extract_mol else iter(molecules)
     w = Chem.SDWriter(str(sdf_path))
-    for m in molecules:
-        if extract_mol:
-            if m.rdkit_mol is not None:
-                w.write(m.rdkit_mol)
-        else:
+    try:
+        for m in mols:
             if m is not None:
                 w.write(m)
-    w.close()
+    finally:
+        w.close()
 
 
 def unbatch_data(
@@ -1806,31 +1805,28 @@ def retrieve_interactions_per_mol(interactions_df):
     """
     Get a dictionary with interaction metrics per molecule
     """
-    interactions_list = [i[-1] for i in interactions_df.columns]
     interactions_dict = defaultdict(list)
-    for i in range(len(interactions_df)):
-        tmp_dict = defaultdict(list)
-        for k, row in enumerate(interactions_df.iloc[i, :]):
-            tmp_dict[interactions_list[k]].append(row)
-        for key, value in tmp_dict.items():
-            interactions_dict[key].append(np.sum(value))
+    if len(interactions_df) == 0:
+        return interactions_dict, {}
+
+    # sum all columns sharing the same interaction type (last column level)
+    interactions_list = [i[-1] for i in interactions_df.columns]
+    summed = interactions_df.T.groupby(interactions_list, sort=False).sum().T
+    for key in summed.columns:
+        interactions_dict[key] = summed[key].to_numpy().tolist()
 
     interactions = {
-        k: {"mean": np.mean(v), "std": np.std(v)} for k, v in interactions_dict.items()
+        k: {"mean": float(v.mean()), "std": float(v.std(ddof=0))}
+        for k, v in summed.items()
     }
     return interactions_dict, interactions
 
 
 def split_list(data, num_chunks):
-    chunk_size = len(data) // num_chunks
-    remainder = len(data) % num_chunks
-    chunks = []
-    start = 0
-    for i in range(num_chunks):
-        chunk_end = start + chunk_size + (1 if i < remainder else 0)
-        chunks.append(data[start:chunk_end])
-        start = chunk_end
-    return chunks
+    # same partitioning as np.array_split: the first `remainder` chunks get one extra element
+    chunk_size, remainder = divmod(len(data), num_chunks)
+    bounds = [i * chunk_size + min(i, remainder) for i in range(num_chunks + 1)]
+    return [data[bounds[i] : bounds[i + 1]] for i in range(num_chunks)]
 
 
 def prepare_data(